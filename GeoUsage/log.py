@@ -25,15 +25,36 @@
 
 __version__ = '0.1.0'
 
-from datetime import datetime
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
 import gzip
-import ipaddress
+import io
+from itertools import islice
+import locale
 import logging
+import mmap
+from operator import attrgetter, is_not
+import os
+import re
 import socket
+import sys
+from struct import pack, unpack
 from urllib.parse import unquote
 
 import click
 
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
 LOGGER = logging.getLogger(__name__)
 
 SERVICE_TYPES = {
@@ -42,9 +63,58 @@ SERVICE_TYPES = {
     'OGC:WPS': 'WPS'
 }
 
+_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+# read buffer size for logfiles
+READ_BUFFER_SIZE = 128 * 1024
+
+# number of lines per chunk when processing logfiles in parallel
+CHUNK_SIZE = 10000
+
+# maximum number of days of a time filter to prefilter log lines on
+APACHE_DATES_MAX_DAYS = 366
+
+# number of parsed request URLs to cache
+PARSE_REQUEST_CACHE_SIZE = 4096
+
+# number of threads to resolve IP addresses with
+RESOLVE_IPS_WORKERS = 64
+
+# last parsed Apache datetime string and its value (log records are
+# time ordered, so many consecutive lines share the same timestamp)
+_LAST_DATETIME = (None, None)
+
+# Apache combined log format
+_LINE_RE = re.compile(
+    r'^(\S+) \S+ \S+ \[([^\]]+)\] "(\S+) (\S+) (\S+)" (\S+) (\S+) '
+    r'"([^"]*)" "(.*)"$')
+
+# log record attribute getters for batch counting
+_get_datetime = attrgetter('datetime')
+_get_ip_number = attrgetter('ip_number')
+_get_ows_request = attrgetter('ows_request')
+_get_size = attrgetter('size')
+_get_user_agent = attrgetter('user_agent')
+
+# ISO8601 date (YYYY-MM-DD) or datetime (YYYY-MM-DDTHH:MM:SS)
+_ISO8601_RE = re.compile(
+    r'^([0-9]{4})-([0-9]{2})-([0-9]{2})'
+    r'(?:T([0-9]{2}):([0-9]{2}):([0-9]{2}))?$')
+
+# keyword/value pairs of a URL query string
+_KVP_RE = re.compile(r'([^&=]*)=([^&]*)')
+
 
 class LogRecord:
     """Generic Log Record"""
+
+    __slots__ = ('_line', 'remote_host_ip', 'ip_number', 'datetime',
+                 'timezone', 'request_type', 'request', 'protocol',
+                 'status_code', 'size', 'referer', 'user_agent')
+
     def __init__(self, line):
         """
         Initialize a LogRecord object
@@ -90,52 +160,63 @@ class LogRecord:
         self.user_agent = None
         """User-Agent"""
 
-        LOGGER.debug('Parsing log record')
-        tokens = self._line.split()
+        match = _LINE_RE.match(self._line)
+
+        if match is not None:
+            fields = match.groups()
+        else:  # e.g. quotes within referer
+            fields = split_line(self._line)
 
-        if len(tokens) < 12:
+        if fields is None:
             msg = 'Line does not contain expected apache record format'
             LOGGER.warning(msg)
             raise NotFoundError(msg)
 
+        (remote_host_ip, datetime_, self.request_type, self.request,
+         self.protocol, status_code, size, self.referer,
+         user_agent) = fields
+
+        # user agents and IP addresses repeat heavily, so share strings
+        self.user_agent = sys.intern(user_agent)
+
         # validate IP address
-        self.ip_number = dot2longip(tokens[0])
+        self.ip_number = dot2longip(remote_host_ip)
         if self.ip_number != 0:
-            self.remote_host_ip = tokens[0]
+            self.remote_host_ip = sys.intern(remote_host_ip)
+
+        datetime_, _, self.timezone = datetime_.partition(' ')
 
         try:
-            self.datetime = datetime.strptime(tokens[3].lstrip('['),
-                                              '%d/%b/%Y:%H:%M:%S')
-        except ValueError:
+            self.datetime = parse_apache_datetime(datetime_)
+        except (KeyError, ValueError):
             msg = ('Datetime token ({}) that does not match the expected '
-                   'datetime format').format(tokens[3].lstrip('['))
+                   'datetime format').format(datetime_)
             LOGGER.warning(msg)
             raise NotFoundError(msg)
 
-        self.timezone = tokens[4].rstrip(']')
-        self.request_type = tokens[5].lstrip('"')
-        self.request = tokens[6]
-        self.protocol = tokens[7].rstrip('"')
-
         try:
-            self.status_code = int(tokens[8])
-            if tokens[9] != '-':  # ignore size values that are "-"
-                self.size = int(tokens[9])
+            self.status_code = int(status_code)
+            if size != '-':  # ignore size values that are "-"
+                self.size = int(size)
         except ValueError:
             msg = ('Status code ({}) or size ({}) are invalid literals for '
-                   'int type').format(tokens[8], tokens[9])
+                   'int type').format(status_code, size)
             LOGGER.warning(msg)
             raise NotFoundError(msg)
 
-        self.referer = tokens[10].replace('"', '')
-        self.user_agent = ' '.join(tokens[11:]).lstrip('"').rstrip('"')
-
     def __repr__(self):
         return '<LogRecord> {}'.format(self.request)
 
 
 class OWSLogRecord(LogRecord):
     """OWS Log Record"""
+
+    __slots__ = ('baseurl', 'service', 'version', 'ows_request', 'crs',
+                 'format', 'ows_resource', 'styles', 'kvp', 'identifier')
+
+    resource = 'layers'
+    """OWS parameter to identify resource"""
+
     def __init__(self, line, endpoint=None, service_type=None):
         """
         Initialize an OWSLogRecord object
@@ -173,6 +254,12 @@ class OWSLogRecord(LogRecord):
         self.kvp = {}
         """keyword/value of request parameters and values"""
 
+        # cheap check before parsing the line
+        if endpoint is not None and endpoint not in line:
+            msg = 'Log record endpoint not found'
+            LOGGER.warning(msg)
+            raise NotFoundError(msg)
+
         try:
             LogRecord.__init__(self, line)
         except (NotFoundError, ValueError):
@@ -180,34 +267,31 @@ class OWSLogRecord(LogRecord):
             LOGGER.error(msg)
             raise NotFoundError(msg)
 
-        LOGGER.debug('Analyzing URL match')
-
         if endpoint is not None and not self.request.startswith(endpoint):
             msg = 'Log record endpoint not found'
             LOGGER.warning(msg)
             raise NotFoundError(msg)
 
-        LOGGER.debug('Splitting OWS request line')
-
-        parsed_request = parse_request(self.request)
+        parsed_request = _parse_request_cached(self.request)
         self.baseurl = parsed_request['baseurl']
         self.service = parsed_request['service']
         self.version = parsed_request['version']
         self.ows_request = parsed_request['ows_request']
+        if self.ows_request is not None:
+            self.ows_request = sys.intern(self.ows_request)
         self.identifier = parsed_request['identifier']
         self.styles = parsed_request['styles']
         self.crs = parsed_request['crs']
         self.format = parsed_request['format']
         self.ows_resource = parsed_request['ows_resource']
-        self.kvp = parsed_request['kvp']
+        self.kvp = parsed_request['kvp'].copy()
 
-        if service_type is not None:
-            if service_type in SERVICE_TYPES:
-                service_type_ = SERVICE_TYPES[service_type]
-                if self.service is not None and service_type_ != self.service:
-                    msg = 'Service type {} not found'.format(service_type_)
-                    LOGGER.error(msg)
-                    raise NotFoundError(msg)
+        service_type_ = SERVICE_TYPES.get(service_type)
+        if (service_type_ is not None and self.service is not None and
+                service_type_ != self.service):
+            msg = 'Service type {} not found'.format(service_type_)
+            LOGGER.error(msg)
+            raise NotFoundError(msg)
 
     def __repr__(self):
         return '<OWSLogRecord> {}'.format(self.request)
@@ -215,6 +299,12 @@ class OWSLogRecord(LogRecord):
 
 class WMSLogRecord(OWSLogRecord):
     """OGC:WMS Log Record"""
+
+    __slots__ = ()
+
+    resource = 'layers'
+    """WMS parameter to identify resource"""
+
     def __init__(self, line, endpoint=None):
         """
         Initialize an OWSLogRecord object
@@ -224,9 +314,6 @@ class WMSLogRecord(OWSLogRecord):
         :returns: GeoUsage.OWSLogRecord instance
         """
 
-        self.resource = 'layers'
-        """WMS parameter to identify resource"""
-
         OWSLogRecord.__init__(self, line, endpoint=endpoint,
                               service_type='OGC:WMS')
 
@@ -236,11 +323,15 @@ class WMSLogRecord(OWSLogRecord):
 
 class WPSLogRecord(OWSLogRecord):
     """OGC:WPS Log Record"""
+
+    __slots__ = ()
+
+    resource = 'identifier'
+    """WPS parameter to identify process"""
+
     def __init__(self, line, endpoint=None):
         OWSLogRecord.__init__(self, line, endpoint=endpoint,
                               service_type='OGC:WPS')
-        self.resource = 'identifier'
-        """WPS parameter to identify process"""
 
         # Workaround: count POST requests as "Execute"
         if self.request_type == 'POST':
@@ -250,23 +341,42 @@ class WPSLogRecord(OWSLogRecord):
         return '<WPSLogRecord> {}'.format(self.request)
 
 
+# service specific log record types
+RECORD_TYPES = {
+    'OGC:WMS': WMSLogRecord,
+    'OGC:WPS': WPSLogRecord
+}
+
+
 def get_record(line, endpoint=None, service_type=None):
-    if service_type == 'OGC:WMS':
-        r = WMSLogRecord(line, endpoint=endpoint)
-    if service_type == 'OGC:WPS':
-        r = WPSLogRecord(line, endpoint=endpoint)
-    else:
-        r = OWSLogRecord(line, endpoint=endpoint, service_type=service_type)
-    return r
+    """
+    Initialize a log record of a given service type
+
+    :param line: access log record line
+    :param endpoint: OWS endpoint (base URL)
+    :param service_type: service type (e.g. OGC:WMS)
+
+    :returns: GeoUsage.OWSLogRecord instance (or subclass thereof)
+    """
+
+    record_type = RECORD_TYPES.get(service_type)
+    if record_type is not None:
+        return record_type(line, endpoint=endpoint)
+
+    return OWSLogRecord(line, endpoint=endpoint, service_type=service_type)
 
 
 class Analyzer:
     """Log Analyzer"""
-    def __init__(self, records=[], resolve_ips=False):
+    def __init__(self, records=[], resolve_ips=False, top=None, counts=None):
         """
         Initialize an Analyzer object
-        :param records: list of LogRecord objects
+        :param records: iterable of LogRecord objects
         :param resolve_ips: resolve IPs (boolean)
+        :param top: only keep top n visitors/resources/user agents
+                    (default keeps all)
+        :param counts: precomputed counts (see `count_records`), used
+                       instead of `records`
 
         :returns: GeoUsage.Analyzer instance
         """
@@ -289,82 +399,363 @@ class Analyzer:
         self.unique_ips = {}
         """unique visitors"""
 
+        self.total_unique_ips = 0
+        """total unique visitors"""
+
         self.resources = {}
         """resources requested and counts"""
 
+        self.total_resources = 0
+        """total unique resources requested"""
+
         self.user_agents = {}
         """user agents and counts"""
 
-        LOGGER.info('Analyzing {} records'.format(len(records)))
+        self.total_user_agents = 0
+        """total unique user agents"""
+
+        if counts is None:
+            counts = count_records(records)
 
-        if len(records) == 0:
+        LOGGER.info('Analyzing {} records'.format(counts['records']))
+
+        if counts['records'] == 0:
             LOGGER.info('No records to analyze')
             return
 
-        self.start = min(item.datetime for item in records)
-        self.end = max(item.datetime for item in records)
-
-        for r in records:
-            LOGGER.debug('Analyzing OWS requests')
-            if r.ows_request is not None:
-                if r.ows_request in self.requests:
-                    self.requests[r.ows_request] += 1
-                else:
-                    self.requests[r.ows_request] = 1
-
-            LOGGER.debug('Analyzing total bytes transferred')
-            self.total_size += r.size
-
-            LOGGER.debug('Analyzing User Agents')
-            if r.user_agent in self.user_agents:
-                self.user_agents[r.user_agent] += 1
-            else:
-                self.user_agents[r.user_agent] = 1
-
-            LOGGER.debug('Analyzing data usage')
-            r_resource = 'layers'  # non-WMSLogRecord
-            if hasattr(r, 'resource'):  # WMSLogRecord
-                r_resource = r.resource
-            if r_resource in r.kvp:
-                # the "layers=" of the request
-                resource_name = r.kvp[r_resource]
-                if resource_name in self.resources:
-                    self.resources[resource_name] += 1
-                else:
-                    self.resources[resource_name] = 1
-
-            LOGGER.debug('Analyzing unique IP addresses')
-            r_remote_host_ip = r.remote_host_ip
-            if r_remote_host_ip in self.unique_ips:
-                self.unique_ips[r_remote_host_ip]['count'] += 1
-            else:
-                self.unique_ips[r_remote_host_ip] = {'count': 1}
-                if resolve_ips:
-                    try:
-                        a = socket.gethostbyaddr(r.remote_host_ip)
-                        hostname = a[0]
-                    except socket.herror:
-                        hostname = None
-                    self.unique_ips[r_remote_host_ip]['hostname'] = hostname
-                else:
-                    self.unique_ips[r_remote_host_ip]['hostname'] = None
+        self.start = counts['start']
+        self.end = counts['end']
+        self.total_size = counts['total_size']
 
         LOGGER.debug('Analyzing total requests')
-        self.total_requests = sum(item for item in self.requests.values())
+        self.total_requests = sum(counts['requests'].values())
+
+        self.total_unique_ips = len(counts['unique_ips'])
+        self.total_resources = len(counts['resources'])
+        self.total_user_agents = len(counts['user_agents'])
+
+        self.requests = counts['requests'].most_common()
+        self.resources = counts['resources'].most_common(top)
+        self.user_agents = counts['user_agents'].most_common(top)
+
+        unique_ips = [(longip2dot(ip_number), count) for ip_number, count
+                      in counts['unique_ips'].most_common(top)]
+        hostnames = [None] * len(unique_ips)
+
+        if resolve_ips and unique_ips:
+            LOGGER.debug('Resolving {} IP addresses'.format(len(unique_ips)))
+            max_workers = min(RESOLVE_IPS_WORKERS, len(unique_ips))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                hostnames = list(executor.map(
+                    resolve_ip, [ip for ip, count in unique_ips]))
 
-        self.requests = sorted(self.requests.items(),
-                               key=lambda x: x[1], reverse=True)
-        self.resources = sorted(self.resources.items(),
-                                key=lambda x: x[1], reverse=True)
-        self.unique_ips = sorted(self.unique_ips.items(),
-                                 key=lambda x: x[1]['count'], reverse=True)
-        self.user_agents = sorted(self.user_agents.items(),
-                                  key=lambda x: x[1], reverse=True)
+        self.unique_ips = [
+            (ip, {'count': count, 'hostname': hostname})
+            for (ip, count), hostname in zip(unique_ips, hostnames)
+        ]
 
     def __repr__(self):
         return '<Analyzer>'
 
 
+def count_records(records):
+    """
+    Counts requests, resources, visitors and user agents of log records
+
+    :param records: iterable of LogRecord objects (consumed in a single
+                    pass, so records need not be held in memory)
+
+    :returns: `dict` of counts, which can be combined with `merge_counts`
+              and analyzed with `Analyzer`
+    """
+
+    counts = {
+        'records': 0,
+        'start': None,
+        'end': None,
+        'total_size': 0,
+        'requests': Counter(),
+        'unique_ips': Counter(),
+        'resources': Counter(),
+        'user_agents': Counter()
+    }
+
+    records = iter(records)
+    is_not_none = partial(is_not, None)
+
+    # count in batches, so that each column is counted in a single
+    # C level pass (Counter.update, map, sum, min, max)
+    while True:
+        batch = list(islice(records, CHUNK_SIZE))
+        if not batch:
+            break
+
+        datetimes = list(map(_get_datetime, batch))
+        start = min(datetimes)
+        end = max(datetimes)
+
+        if counts['start'] is None or start < counts['start']:
+            counts['start'] = start
+        if counts['end'] is None or end > counts['end']:
+            counts['end'] = end
+
+        counts['records'] += len(batch)
+        counts['total_size'] += sum(map(_get_size, batch))
+
+        counts['requests'].update(
+            filter(is_not_none, map(_get_ows_request, batch)))
+        counts['user_agents'].update(map(_get_user_agent, batch))
+
+        # the "layers=" (or "identifier=") of the request
+        counts['resources'].update(
+            filter(is_not_none, (r.kvp.get(r.resource) for r in batch)))
+
+        # keyed by IP number, which is cheaper to hash than a string
+        counts['unique_ips'].update(map(_get_ip_number, batch))
+
+    return counts
+
+
+def merge_counts(counts_list):
+    """
+    Merges the counts of multiple sets of log records
+
+    :param counts_list: list of `dict` of counts (see `count_records`)
+
+    :returns: `dict` of merged counts
+    """
+
+    counts = count_records([])
+
+    for c in counts_list:
+        if c['records'] == 0:
+            continue
+
+        if counts['start'] is None or c['start'] < counts['start']:
+            counts['start'] = c['start']
+        if counts['end'] is None or c['end'] > counts['end']:
+            counts['end'] = c['end']
+
+        counts['records'] += c['records']
+        counts['total_size'] += c['total_size']
+
+        for key in ['requests', 'unique_ips', 'resources', 'user_agents']:
+            counts[key].update(c[key])
+
+    return counts
+
+
+def parse_lines(lines, endpoint=None, service_type=None, times=None):
+    """
+    Parses access log lines, skipping lines which are not valid records
+
+    :param lines: iterable of access log record lines
+    :param endpoint: OWS endpoint (base URL)
+    :param service_type: service type (e.g. OGC:WMS)
+    :param times: list of `datetime.datetime` objects to filter on
+                  (see `parse_iso8601`)
+
+    :returns: generator of LogRecord objects
+    """
+
+    matches_time = None
+    dates = None
+    if times:
+        matches_time = time_matcher(times)
+        dates = apache_dates(times)
+
+    for line in lines:
+        if endpoint is not None and endpoint not in line:
+            continue
+
+        if dates is not None:
+            # skip lines outside the time filter before parsing them
+            i = line.find(' [')
+            if i != -1 and line[i + 2:i + 13] not in dates:
+                continue
+
+        try:
+            r = get_record(line, endpoint=endpoint, service_type=service_type)
+        except NotFoundError:
+            continue
+
+        if matches_time is not None and not matches_time(r.datetime):
+            continue
+
+        yield r
+
+
+def count_lines(lines, endpoint=None, service_type=None, times=None):
+    """
+    Parses and counts access log lines
+
+    :param lines: iterable of access log record lines
+    :param endpoint: OWS endpoint (base URL)
+    :param service_type: service type (e.g. OGC:WMS)
+    :param times: list of `datetime.datetime` objects to filter on
+                  (see `parse_iso8601`)
+
+    :returns: `dict` of counts (see `count_records`)
+    """
+
+    return count_records(parse_lines(lines, endpoint=endpoint,
+                                     service_type=service_type, times=times))
+
+
+def count_logfile(filepath, endpoint=None, service_type=None, times=None,
+                  executor=None, processes=1):
+    """
+    Parses and counts an access log file, in chunks across processes
+
+    :param filepath: path to logfile
+    :param endpoint: OWS endpoint (base URL)
+    :param service_type: service type (e.g. OGC:WMS)
+    :param times: list of `datetime.datetime` objects to filter on
+    :param executor: `concurrent.futures.Executor` to count chunks with
+                     (default counts in a single streaming pass)
+    :param processes: number of processes of `executor`
+
+    :returns: `dict` of counts (see `count_records`)
+    """
+
+    counts = []
+    pending = deque()
+
+    LOGGER.debug('Parsing logfile {}'.format(filepath))
+
+    if executor is not None and not filepath.endswith('gz'):
+        # uncompressed logfiles are split into byte ranges which each
+        # worker reads itself, rather than sending lines to workers
+        size = os.path.getsize(filepath)
+        step = size // processes + 1
+        futures = [
+            executor.submit(count_logfile_range, filepath, start,
+                            start + step, endpoint, service_type, times)
+            for start in range(0, size, step)
+        ]
+        return merge_counts(future.result() for future in futures)
+
+    with open_logfile(filepath) as ff:
+        if executor is None:
+            return count_lines(ff, endpoint=endpoint,
+                               service_type=service_type, times=times)
+
+        while True:
+            chunk = list(islice(ff, CHUNK_SIZE))
+            if not chunk:
+                break
+
+            # bound the number of chunks held in memory, and merge in
+            # file order so that results are identical to a serial run
+            if len(pending) >= processes * 2:
+                counts.append(pending.popleft().result())
+
+            pending.append(executor.submit(count_lines, chunk, endpoint,
+                                           service_type, times))
+
+    counts.extend(future.result() for future in pending)
+
+    return merge_counts(counts)
+
+
+def count_logfile_range(filepath, start, end, endpoint=None,
+                        service_type=None, times=None):
+    """
+    Parses and counts the lines of an uncompressed access log file which
+    start within a byte range
+
+    :param filepath: path to logfile
+    :param start: start byte offset
+    :param end: end byte offset (exclusive)
+    :param endpoint: OWS endpoint (base URL)
+    :param service_type: service type (e.g. OGC:WMS)
+    :param times: list of `datetime.datetime` objects to filter on
+
+    :returns: `dict` of counts (see `count_records`)
+    """
+
+    return count_lines(read_logfile_range(filepath, start, end),
+                       endpoint=endpoint, service_type=service_type,
+                       times=times)
+
+
+def read_logfile_range(filepath, start, end):
+    """
+    Reads the lines of an uncompressed logfile which start within a
+    byte range
+
+    :param filepath: path to logfile
+    :param start: start byte offset
+    :param end: end byte offset (exclusive)
+
+    :returns: generator of lines
+    """
+
+    encoding = locale.getpreferredencoding(False)
+
+    if os.path.getsize(filepath) == 0:  # empty files cannot be mapped
+        return
+
+    with open(filepath, 'rb') as ff, \
+            mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = start
+        if start > 0:
+            # skip the line which started before the range
+            position = mm.find(b'\n', start - 1) + 1
+            if position == 0:
+                return
+
+        while position < end:
+            newline = mm.find(b'\n', position)
+            if newline == -1:  # last line without a newline
+                if position < len(mm):
+                    yield mm[position:].decode(encoding)
+                return
+
+            yield mm[position:newline + 1].decode(encoding)
+            position = newline + 1
+
+
+def split_line(line):
+    """
+    Splits an Apache combined log line on whitespace, as a lenient
+    fallback for lines which do not match the log line regex
+
+    :param line: access log record line
+
+    :returns: `tuple` of remote host, datetime (with timezone), request
+              type, request, protocol, status code, size, referer and
+              user agent, or `None` if the line has too few tokens
+    """
+
+    tokens = line.split()
+
+    if len(tokens) < 12:
+        return None
+
+    return (tokens[0], '{} {}'.format(tokens[3].lstrip('['),
+                                      tokens[4].rstrip(']')),
+            tokens[5].lstrip('"'), tokens[6], tokens[7].rstrip('"'),
+            tokens[8], tokens[9], unquote_field(tokens[10]),
+            unquote_field(' '.join(tokens[11:])))
+
+
+def unquote_field(value):
+    """
+    Removes the surrounding quotes of a quoted Apache log field, keeping
+    quotes escaped within it
+
+    :param value: quoted field (e.g. `"a \\"b\\""`)
+
+    :returns: field value
+    """
+
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        value = value[1:-1]
+
+    return value.replace('\\"', '"')
+
+
 def parse_iso8601(value):
     """
     Convenience function to parse ISO8601
@@ -380,7 +771,10 @@ def parse_iso8601(value):
     time_tokens = value.split('/')
     LOGGER.debug('{} time tokens found'.format(len(time_tokens)))
     for tt in time_tokens:
-        if 'T' in tt:   # YYYY-MM-DDTHH:MM:SS
+        match = _ISO8601_RE.match(tt)
+        if match is not None:  # zero padded YYYY-MM-DD[THH:MM:SS]
+            t = datetime(*(int(v) for v in match.groups() if v is not None))
+        elif 'T' in tt:   # YYYY-MM-DDTHH:MM:SS
             LOGGER.debug('datetime found')
             t = datetime.strptime(tt, '%Y-%m-%dT%H:%M:%S')
         else:
@@ -391,6 +785,97 @@ def parse_iso8601(value):
     return time_values
 
 
+def parse_apache_datetime(value):
+    """
+    Parses an Apache access log datetime (DD/Mon/YYYY:HH:MM:SS)
+
+    Avoids `datetime.strptime`, which is the dominant cost of parsing
+    a log record, and reuses the previous result when consecutive
+    records share the same timestamp
+
+    :param value: datetime string
+
+    :returns: `datetime.datetime` object
+    """
+
+    global _LAST_DATETIME
+
+    # the cached (value, result) pair is read and rebound as one tuple so
+    # that concurrent threads never see a value with another's result
+    last_value, last_result = _LAST_DATETIME
+    if value == last_value:
+        return last_result
+
+    if (len(value) != 20 or value[2] != '/' or value[6] != '/' or
+            value[11] != ':' or value[14] != ':' or value[17] != ':'):
+        raise ValueError('Invalid datetime: {}'.format(value))
+
+    digits = (value[0:2] + value[7:11] + value[12:14] + value[15:17] +
+              value[18:20])
+    if not digits.isdigit():
+        raise ValueError('Invalid datetime: {}'.format(value))
+
+    result = datetime(int(value[7:11]), _MONTHS[value[3:6]], int(value[0:2]),
+                      int(value[12:14]), int(value[15:17]),
+                      int(value[18:20]))
+
+    _LAST_DATETIME = (value, result)
+
+    return result
+
+
+def time_matcher(times, datetype='date'):
+    """
+    Builds a test of a time against a time instant or time range, with
+    the bounds computed once
+
+    :param times: list of `datetime.datetime` objects
+    :param datetype: type of `datetime` object (`date` or `datetime`)
+
+    :returns: function which accepts a `datetime.datetime` object and
+              returns a boolean of whether time matches or is in range
+    """
+
+    if datetype == 'datetime':   # datetime.datetime comparison
+        # a time instant is a range with equal bounds
+        start, end = times[0], times[-1]
+        return lambda intime: start <= intime <= end
+
+    # datetime.date comparison, as [start of first day, start of next day)
+    start = datetime.combine(times[0].date(), datetime.min.time())
+    end = datetime.combine(times[-1].date(), datetime.min.time())
+    end += timedelta(days=1)
+
+    return lambda intime: start <= intime < end
+
+
+def apache_dates(times):
+    """
+    Lists the Apache access log dates (DD/Mon/YYYY) of a time instant or
+    time range, to filter log lines on before parsing them
+
+    :param times: list of `datetime.datetime` objects
+
+    :returns: `set` of dates, or `None` if the time range is too long
+    """
+
+    start = times[0].date()
+    days = (times[-1].date() - start).days + 1
+
+    if days > APACHE_DATES_MAX_DAYS:
+        return None
+
+    months = {value: key for key, value in _MONTHS.items()}
+    dates = set()
+
+    for day in range(days):
+        date = start + timedelta(days=day)
+        dates.add('{:02d}/{}/{:04d}'.format(date.day, months[date.month],
+                                            date.year))
+
+    return dates
+
+
 def test_time(intime, times, datetype='date'):
     """
     Tests intime against a time instant or time range
@@ -402,27 +887,7 @@ def test_time(intime, times, datetype='date'):
     :returns: boolean of whether time matches or is in range
     """
 
-    result = False
-
-    if len(times) == 1:  # time instant comparison
-        LOGGER.debug('comparing time instant')
-        if datetype == 'datetime':   # datetime.datetime comparison
-            LOGGER.debug('comparing datetime instant')
-            result = intime == times[0]
-        else:   # datetime.date comparison
-            LOGGER.debug('comparing date instant')
-            result = intime.date() == times[0].date()
-    else:   # time range comparison
-        LOGGER.debug('comparing time range')
-        if datetype == 'datetime':   # datetime.datetime comparison
-            LOGGER.debug('comparing datetime range')
-            result = intime <= times[1] and intime >= times[0]
-        else:   # datetime.date comparison
-            LOGGER.debug('comparing date range')
-            result = (intime.date() <= times[1].date() and
-                      intime.date() >= times[0].date())
-
-    return result
+    return time_matcher(times, datetype=datetype)(intime)
 
 
 def dot2longip(ip):
@@ -431,17 +896,42 @@ def dot2longip(ip):
     ip_number = 0
 
     try:
-        parsed_ip = ipaddress.IPv4Address(ip)
-        ip_number = int(parsed_ip)
-    except (AddressValueError, ipaddress.AddressValueError):
+        ip_number = unpack('>I', socket.inet_pton(socket.AF_INET, ip))[0]
+    except (OSError, TypeError, ValueError):
         ip_number = 0
-        msg = ('Could not convert this IP address to an IP number: {}.'
-               'Skipping...').format(ip)
-        LOGGER.debug(msg)
+        LOGGER.debug('Could not convert this IP address to an IP number: '
+                     '%s. Skipping...', ip)
 
     return ip_number
 
 
+def longip2dot(ip_number):
+    """Converts an IP number to an IPv4 address (`None` for 0)"""
+
+    if not ip_number:
+        return None
+
+    return socket.inet_ntoa(pack('>I', ip_number))
+
+
+def resolve_ip(ip):
+    """
+    Resolves the hostname of an IP address
+
+    :param ip: IP address
+
+    :returns: hostname, or `None` if the IP address cannot be resolved
+    """
+
+    if ip is None:
+        return None
+
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except socket.herror:
+        return None
+
+
 def parse_request(url_request):
     """Parses the URL request and returns a dict of the parsed results"""
 
@@ -457,21 +947,21 @@ def parse_request(url_request):
         'format': None,
         'identifier': None,
     }
-    _kvps = ''
 
-    if '?' in url_request:
-        results['baseurl'], _kvps = url_request.split('?', 1)
-    else:
+    if '?' not in url_request:
         results['baseurl'] = url_request
-        msg = ('Log record has non OWS URL from this request\
-            : {}.\n').format(url_request)
-        LOGGER.debug(msg)
+        LOGGER.debug('Log record has non OWS URL from this request: %s',
+                     url_request)
+        return results
 
-    for _kvp in _kvps.split('&'):
-        LOGGER.debug('keyword/value pair: {}'.format(_kvp))
-        if '=' in _kvp:
-            k, v = _kvp.split('=', 1)
-            results['kvp'][unquote(k.lower())] = unquote(v)  # URL decoding
+    results['baseurl'], _kvps = url_request.split('?', 1)
+
+    # URL decoding
+    results['kvp'] = {
+        (unquote(k.lower()) if '%' in k else k.lower()):
+        (unquote(v) if '%' in v else v)
+        for k, v in _KVP_RE.findall(_kvps)
+    }
 
     if 'service' in results['kvp']:
         results['service'] = results['kvp']['service']
@@ -505,6 +995,41 @@ def parse_request(url_request):
     return results
 
 
+def open_logfile(filepath):
+    """
+    Opens a (possibly gzip compressed) logfile for line by line reading.
+    gzip compressed logfiles are decompressed in parallel if rapidgzip
+    is installed, else with ISA-L if python-isal is installed
+
+    :param filepath: path to logfile
+
+    :returns: text file object
+    """
+
+    if filepath.endswith('gz'):
+        if rapidgzip is not None:
+            LOGGER.debug('Decompressing with rapidgzip')
+            return io.TextIOWrapper(
+                rapidgzip.open(filepath, parallelization=0))
+
+        if igzip is not None:
+            LOGGER.debug('Decompressing with python-isal')
+            gzip_open = igzip.open
+        else:
+            gzip_open = gzip.open
+
+        return io.TextIOWrapper(
+            io.BufferedReader(gzip_open(filepath), READ_BUFFER_SIZE))
+
+    return open(filepath, 'rt', buffering=READ_BUFFER_SIZE)
+
+
+# parsed requests are shared between records with the same request URL,
+# which is common for OWS logs (GetCapabilities, tiled GetMap, etc.)
+_parse_request_cached = lru_cache(maxsize=PARSE_REQUEST_CACHE_SIZE)(
+    parse_request)
+
+
 class NotFoundError(Exception):
     """Value not found Exception"""
     pass
@@ -538,13 +1063,15 @@ def log():
               help='time filter (ISO8601 instance or start/end)')
 @click.option('--top', '-top', 'top', default=10,
               help='only show top n visitors/resources (default 10)')
+@click.option('--processes', '-p', 'processes', default=1,
+              type=click.IntRange(min=1),
+              help='number of processes to parse logfiles with (default 1)')
 @click.option('--verbosity', type=click.Choice(['ERROR', 'WARNING',
               'INFO', 'DEBUG']), help='Verbosity')
 def analyze(ctx, logfile, endpoint, verbosity, top, resolve_ips,
-            service_type, time_):
+            service_type, time_, processes):
     """parse http access log"""
 
-    records = []
     time__ = []
 
     if verbosity is not None:
@@ -558,47 +1085,25 @@ def analyze(ctx, logfile, endpoint, verbosity, top, resolve_ips,
     if time_ is not None:
         time__ = parse_iso8601(time_)
 
-    for logfile_ in logfile:
-        if logfile_.endswith('gz'):
-            open_ = gzip.open
-        else:
-            open_ = open
-        with open_(logfile_, 'rt') as ff:
-            for line in ff.readlines():
-                try:
-                    r = get_record(line, endpoint=endpoint,
-                                   service_type=service_type)
-                    if time_ is not None:
-                        if test_time(r.datetime, time__):
-                            LOGGER.debug('Adding line based on time filter')
-                            records.append(r)
-                        else:
-                            LOGGER.debug('Skipping line based on time filter')
-                    else:
-                        records.append(r)
-                except NotFoundError:
-                    pass
-
-    if len(records) == 0:
-        raise click.ClickException('No records to analyze')
-
-    a = Analyzer(records, resolve_ips=resolve_ips)
+    executor = None
+    if processes > 1:
+        executor = ProcessPoolExecutor(max_workers=processes)
 
-    if top is not None:
-        total_resources_to_display = top
-        total_unique_ips_to_display = top
-        total_user_agents_to_display = top
-    else:
-        total_resources_to_display = len(a.resources)
-        total_unique_ips_to_display = len(a.unique_ips)
-        total_user_agents_to_display = len(a.user_agents)
+    try:
+        counts = merge_counts([
+            count_logfile(logfile_, endpoint=endpoint,
+                          service_type=service_type, times=time__,
+                          executor=executor, processes=processes)
+            for logfile_ in logfile
+        ])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if counts['records'] == 0:
+        raise click.ClickException('No records to analyze')
 
-    if total_resources_to_display > len(a.resources):
-        total_resources_to_display = len(a.resources)
-    if total_unique_ips_to_display > len(a.unique_ips):
-        total_unique_ips_to_display = len(a.unique_ips)
-    if total_user_agents_to_display > len(a.user_agents):
-        total_user_agents_to_display = len(a.user_agents)
+    a = Analyzer(resolve_ips=resolve_ips, top=top, counts=counts)
 
     click.echo('\nGeoUsage Analysis')
     click.echo('=================\n')
@@ -608,22 +1113,22 @@ def analyze(ctx, logfile, endpoint, verbosity, top, resolve_ips,
     click.echo('Total bytes transferred: {}\n'.format(a.total_size))
     click.echo(
         'Unique visitors (showing top {} of {}):'.format(
-            total_unique_ips_to_display, len(a.unique_ips)))
-    for req in a.unique_ips[:total_unique_ips_to_display]:
+            len(a.unique_ips), a.total_unique_ips))
+    for req in a.unique_ips:
         click.echo('    {} ({}): {}'.format(req[0], req[1]['hostname'],
                                             req[1]['count']))
     click.echo('\nRequests ({}):'.format(a.total_requests))
     for req in a.requests:
         click.echo('    {}: {}'.format(req[0], req[1]))
     click.echo('\nRequested data (showing top {} of {}):'.format(
-        total_resources_to_display, len(a.resources)))
+        len(a.resources), a.total_resources))
 
-    for res in a.resources[:total_resources_to_display]:
+    for res in a.resources:
         click.echo('    {}: {}'.format(res[0], res[1]))
     click.echo('\nUser agents (showing top {} of {}):'.format(
-        total_user_agents_to_display, len(a.user_agents)))
+        len(a.user_agents), a.total_user_agents))
 
-    for res in a.user_agents[:total_user_agents_to_display]:
+    for res in a.user_agents:
         click.echo('    {}: {}'.format(res[0], res[1]))
 
 
@@ -32,6 +32,8 @@ import requests
 
 LOGGER = logging.getLogger(__name__)
 
+_MEMBERS_RE = re.compile(rb'(\d+) members total')
+
 
 class MailmanAdmin:
     """Mailman admin interface"""
@@ -70,10 +72,8 @@ class MailmanAdmin:
                                  data={'adminpw': self.password})
         LOGGER.debug('Parsing HTML')
 
-        element = re.search(r'(\d+) members total', response.text).group(0)
-        members = int(element.split('members total')[0].strip())
-
-        return members
+        # search the raw bytes to avoid decoding the whole page
+        return int(_MEMBERS_RE.search(response.content).group(1))
 
 
 @click.group()
@@ -23,21 +23,25 @@
 #
 ###############################################################################
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+import gzip
+import hashlib
 import os
+import tempfile
 import time
 import unittest
+from unittest.mock import patch
 from unittest.runner import TextTestResult
 from unittest import TextTestRunner
 
-try:
-    from unittest.mock import patch
-except ImportError:
-    from mock import patch
-
-
 from GeoUsage.log import (Analyzer, NotFoundError, OWSLogRecord, WMSLogRecord,
-                          parse_iso8601, test_time, dot2longip, parse_request)
+                          WPSLogRecord, apache_dates, count_logfile,
+                          count_records, get_record, merge_counts,
+                          open_logfile, parse_apache_datetime, parse_iso8601,
+                          read_logfile_range, test_time, dot2longip,
+                          longip2dot, parse_request, parse_lines)
 from GeoUsage.mailing_list import MailmanAdmin
 
 THISDIR = os.path.dirname(os.path.realpath(__file__))
@@ -49,18 +53,18 @@ class TimeLoggingTestResult(TextTestResult):
     """Outputs timing of slow running tests. Slowness threshold is the number
     of seconds defined by SLOW_TEST_THRESHOLD"""
 
-    def start_test(self, test):
-        self._started_at = time.time()
-        super().start_test(test)
+    def startTest(self, test):
+        self._started_at = time.perf_counter()
+        super().startTest(test)
 
-    def add_success(self, test):
-        elapsed = time.time() - self._started_at
-        m, s = divmod(elapsed, 60)
-        h, m = divmod(m, 60)
+    def addSuccess(self, test):
+        elapsed = time.perf_counter() - self._started_at
         if elapsed > SLOW_TEST_THRESHOLD:
+            m, s = divmod(elapsed, 60)
+            h, m = divmod(m, 60)
             name = self.getDescription(test)
             self.stream.write("\n{} ({}h {}m {:.03}s)\n".format(name, h, m, s))
-        super().add_success(test)
+        super().addSuccess(test)
 
 
 class LogTest(unittest.TestCase):
@@ -69,20 +73,19 @@ class LogTest(unittest.TestCase):
     def test_log(self):
         """test log functionality"""
 
-        records = []
-
-        access_log = get_abspath('access.log')
-
-        with open(access_log, 'rt') as ff:
-            for line in ff:
-                try:
-                    lr = WMSLogRecord(line)
-                    records.append(lr)
-                except NotFoundError:
-                    pass
+        records = get_access_log_records()
 
         self.assertEqual(len(records), 341)
 
+        # checksum of the main fields of every record
+        digest = hashlib.blake2b(digest_size=16)
+        for r in records:
+            digest.update('{}|{}|{}|{}|{}\n'.format(
+                r.remote_host_ip, r.datetime.isoformat(), r.request,
+                r.status_code, r.size).encode())
+        self.assertEqual(digest.hexdigest(),
+                         '252cc8c899bb3225da9b4ccc1cbd9a83')
+
         single_record = records[4]
         self.assertEqual(single_record._line, '131.235.251.154 - - [23/Jan/2018:13:09:45 +0000] "GET /geomet/?service=WMS&version=1.3.0&request=GetCapabilities HTTP/1.1" 200 101395 "-" "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:57.0) Gecko/20100101 Firefox/57.0"')  # noqa
         self.assertEqual(single_record.remote_host_ip, '131.235.251.154')
@@ -107,16 +110,144 @@ class LogTest(unittest.TestCase):
 
         # constrain to a specific endpoint
         records = []
-        with open(access_log) as ff:
-            for line in ff:
-                try:
-                    lr = WMSLogRecord(line, endpoint='/geomet2')
-                    records.append(lr)
-                except NotFoundError:
-                    pass
+        for line in get_access_log_lines():
+            try:
+                lr = WMSLogRecord(line, endpoint='/geomet2')
+                records.append(lr)
+            except NotFoundError:
+                pass
 
         self.assertEqual(len(records), 0)
 
+        # referer with spaces and a malformed line
+        line = '10.0.0.1 - - [23/Jan/2018:13:09:45 +0000] "GET /geomet?service=WMS HTTP/1.1" 200 - "a b" "c d"'  # noqa
+        lr = WMSLogRecord(line)
+        self.assertEqual(lr.size, 0)
+        self.assertEqual(lr.referer, 'a b')
+        self.assertEqual(lr.user_agent, 'c d')
+
+        with self.assertRaises(NotFoundError):
+            WMSLogRecord('10.0.0.1 - - [23/Jan/2018:13:09:45 +0000] "GET"')
+
+        # quotes within referer
+        line = '10.0.0.1 - - [23/Jan/2018:13:09:45 +0000] "GET /geomet?service=WMS HTTP/1.1" 200 5 "a\\"b" "c d"'  # noqa
+        lr = WMSLogRecord(line)
+        self.assertEqual(lr.status_code, 200)
+        self.assertEqual(lr.referer, 'a"b')
+        self.assertEqual(lr.user_agent, 'c d')
+
+    def test_get_record(self):
+        """test GeoUsage.log.get_record"""
+
+        line = '10.0.0.1 - - [23/Jan/2018:13:09:45 +0000] "GET /geomet?request=GetCapabilities HTTP/1.1" 200 - "-" "-"'  # noqa
+
+        self.assertIsInstance(get_record(line, service_type='OGC:WMS'),
+                              WMSLogRecord)
+        self.assertIsInstance(get_record(line, service_type='OGC:WPS'),
+                              WPSLogRecord)
+
+        r = get_record(line, service_type='OGC:WCS')
+        self.assertIs(type(r), OWSLogRecord)
+
+    def test_open_logfile(self):
+        """test GeoUsage.log.open_logfile"""
+
+        access_log = get_abspath('access.log')
+
+        lines = list(get_access_log_lines())
+
+        with open_logfile(access_log) as ff:
+            self.assertEqual(list(ff), lines)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            access_log_gz = os.path.join(tmpdir, 'access.log.gz')
+            with gzip.open(access_log_gz, 'wt') as ff:
+                ff.writelines(lines)
+
+            with open_logfile(access_log_gz) as ff:
+                self.assertEqual(list(ff), lines)
+
+    def test_read_logfile_range(self):
+        """test GeoUsage.log.read_logfile_range"""
+
+        access_log = get_abspath('access.log')
+        size = os.path.getsize(access_log)
+
+        lines = list(get_access_log_lines())
+
+        for step in [1000, size]:
+            result = []
+            for start in range(0, size, step):
+                result.extend(read_logfile_range(access_log, start,
+                                                 start + step))
+            self.assertEqual(result, lines)
+
+        # one byte ranges, ranges ending on and just past a newline,
+        # empty lines and a last line without a newline
+        lines = ['a\n', 'bb\n', '\n', 'ccc\n', 'd']
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logfile = os.path.join(tmpdir, 'access.log')
+            with open(logfile, 'w') as ff:
+                ff.writelines(lines)
+
+            size = os.path.getsize(logfile)
+            for step in range(1, size + 1):
+                result = []
+                for start in range(0, size, step):
+                    result.extend(read_logfile_range(logfile, start,
+                                                     start + step))
+                self.assertEqual(result, lines)
+
+    def test_count_logfile(self):
+        """test GeoUsage.log.count_logfile"""
+
+        access_log = get_abspath('access.log')
+
+        counts = count_logfile(access_log, service_type='OGC:WMS')
+        self.assertEqual(counts['records'], 341)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            self.assertEqual(count_logfile(access_log,
+                                           service_type='OGC:WMS',
+                                           executor=executor, processes=3),
+                             counts)
+
+        # time filter, matched through time_matcher
+        times = [datetime(2018, 1, 25), datetime(2018, 1, 26)]
+        counts = count_records([r for r in get_access_log_records()
+                                if test_time(r.datetime, times)])
+        self.assertEqual(counts['records'], 249)
+
+        self.assertEqual(count_logfile(access_log, service_type='OGC:WMS',
+                                       times=times), counts)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            self.assertEqual(count_logfile(access_log,
+                                           service_type='OGC:WMS',
+                                           times=times, executor=executor,
+                                           processes=3),
+                             counts)
+
+    def test_parse_lines(self):
+        """test GeoUsage.log.parse_lines"""
+
+        lines = get_access_log_lines()
+        records = list(parse_lines(lines))
+
+        # single date, date range and a range too long to prefilter on
+        for times in [[datetime(2018, 1, 23, 12, 0)],
+                      [datetime(2018, 1, 25), datetime(2018, 1, 26)],
+                      [datetime(2017, 1, 1), datetime(2018, 1, 26)]]:
+            expected = [r._line for r in records
+                        if test_time(r.datetime, times)]
+            self.assertTrue(0 < len(expected) < len(records))
+
+            result = [r._line for r in parse_lines(lines, times=times)]
+            self.assertEqual(result, expected)
+
+        self.assertIsNone(apache_dates(times))
+
     def test_parse_iso8601(self):
         """test GeoUsage.log.parse_iso8601"""
 
@@ -133,6 +264,44 @@ class LogTest(unittest.TestCase):
         self.assertEqual(result, [datetime(2011, 11, 11, 0, 0),
                                   datetime(2012, 11, 23, 0, 0)])
 
+    def test_parse_apache_datetime(self):
+        """test GeoUsage.log.parse_apache_datetime"""
+
+        val = '23/Jan/2018:13:09:45'
+        result = parse_apache_datetime(val)
+        self.assertEqual(result, datetime(2018, 1, 23, 13, 9, 45))
+
+        # repeated timestamp
+        self.assertIs(parse_apache_datetime(val), result)
+
+        with self.assertRaises(KeyError):
+            parse_apache_datetime('23/Foo/2018:13:09:45')
+
+        with self.assertRaises(ValueError):
+            parse_apache_datetime('23/Jan/2018:13:09')
+
+        with self.assertRaises(ValueError):
+            parse_apache_datetime('32/Jan/2018:13:09:45')
+
+        for val in ['23-Jan-2018 13:09:45', '23/Jan/2018:1 :09:45',
+                    '+3/Jan/2018:13:09:45']:
+            with self.assertRaises(ValueError):
+                parse_apache_datetime(val)
+
+    def test_apache_dates(self):
+        """test GeoUsage.log.apache_dates"""
+
+        result = apache_dates([datetime(2011, 11, 11, 11, 11, 11)])
+        self.assertEqual(result, {'11/Nov/2011'})
+
+        result = apache_dates([datetime(2011, 12, 31),
+                               datetime(2012, 1, 2)])
+        self.assertEqual(result, {'31/Dec/2011', '01/Jan/2012',
+                                  '02/Jan/2012'})
+
+        result = apache_dates([datetime(2011, 1, 1), datetime(2013, 1, 1)])
+        self.assertIsNone(result)
+
     def test_test_time(self):
         """test GeoUsage.log.test_test_time"""
 
@@ -197,6 +366,17 @@ class LogTest(unittest.TestCase):
         ip_number = dot2longip(ip)
         self.assertEqual(ip_number, 0)
 
+        ip = '1.2.3.4\x00'
+        ip_number = dot2longip(ip)
+        self.assertEqual(ip_number, 0)
+
+    def test_longip2dot(self):
+        """Test function that converts an IP number to an IP address"""
+
+        self.assertEqual(longip2dot(2899906414), '172.217.15.110')
+        self.assertEqual(longip2dot(391038589), '23.78.198.125')
+        self.assertEqual(longip2dot(0), None)
+
     def test_parse_request(self):
         """Test function that parses the URL request"""
 
@@ -228,17 +408,7 @@ class AnalyzerTest(unittest.TestCase):
     def test_analyzer(self):
         """test log analysis functionality"""
 
-        records = []
-
-        access_log = get_abspath('access.log')
-
-        with open(access_log) as ff:
-            for line in ff:
-                try:
-                    lr = WMSLogRecord(line)
-                    records.append(lr)
-                except NotFoundError:
-                    pass
+        records = get_access_log_records()
 
         self.assertEqual(len(records), 341)
 
@@ -251,8 +421,38 @@ class AnalyzerTest(unittest.TestCase):
         self.assertEqual(len(a.unique_ips), 8)
 
         unique_ips = dict(a.unique_ips)
-        self.assertTrue('131.235.251.154' in unique_ips)
-        self.assertTrue(unique_ips['131.235.251.154']['count'], 24)
+        self.assertIn('131.235.251.154', unique_ips)
+        self.assertEqual(unique_ips['131.235.251.154']['count'], 24)
+
+        a = Analyzer(records, top=3)
+        self.assertEqual(len(a.unique_ips), 3)
+        self.assertEqual(a.total_unique_ips, 8)
+        self.assertEqual(a.unique_ips[0][0], '142.135.161.98')
+        self.assertEqual(len(a.resources), 3)
+        self.assertEqual(a.resources[0], ('RDPS.ETA_PN', 163))
+
+        counts = merge_counts([count_records(records[:100]),
+                               count_records([]),
+                               count_records(records[100:])])
+        self.assertEqual(counts, count_records(records))
+
+        a2 = Analyzer(iter(records), top=3)
+        self.assertEqual(a2.unique_ips, a.unique_ips)
+
+        a2 = Analyzer(top=3, counts=counts)
+        self.assertEqual(a2.start, a.start)
+        self.assertEqual(a2.end, a.end)
+        self.assertEqual(a2.total_size, a.total_size)
+        self.assertEqual(a2.requests, a.requests)
+        self.assertEqual(a2.unique_ips, a.unique_ips)
+
+        with patch('socket.gethostbyaddr') as mock_gethostbyaddr:
+            mock_gethostbyaddr.return_value = ('example.org', [], [])
+            a2 = Analyzer(records, resolve_ips=True, top=3)
+            self.assertEqual(mock_gethostbyaddr.call_count, 3)
+            self.assertEqual(a2.unique_ips[0],
+                             ('142.135.161.98', {'count': 156,
+                                                 'hostname': 'example.org'}))
 
         a = Analyzer([])
         self.assertEqual(a.start, None)
@@ -260,9 +460,7 @@ class AnalyzerTest(unittest.TestCase):
         self.assertEqual(a.requests, {})
 
         with self.assertRaises(NotFoundError):
-            with open(access_log) as ff:
-                for line in ff:
-                    lr = OWSLogRecord(line, service_type='OGC:WFS')
+            OWSLogRecord(records[4]._line, service_type='OGC:WFS')
 
 
 class MailmanAdminTest(unittest.TestCase):
@@ -273,7 +471,7 @@ class MailmanAdminTest(unittest.TestCase):
         """test mailing list member count"""
 
         mock_get.return_value.ok = True
-        mock_get.return_value.text = '18 members total'
+        mock_get.return_value.content = b'18 members total'
 
         ma = MailmanAdmin('http://example.org/mailmain/admin/list', 'secret')
 
@@ -286,6 +484,29 @@ def get_abspath(filepath):
     return os.path.join(THISDIR, filepath)
 
 
+@lru_cache(maxsize=None)
+def get_access_log_lines():
+    """helper function to read the test access log once"""
+
+    with open(get_abspath('access.log'), 'rt') as ff:
+        return tuple(ff)
+
+
+@lru_cache(maxsize=None)
+def get_access_log_records():
+    """helper function to parse the test access log once"""
+
+    records = []
+
+    for line in get_access_log_lines():
+        try:
+            records.append(WMSLogRecord(line))
+        except NotFoundError:
+            pass
+
+    return tuple(records)
+
+
 if __name__ == '__main__':
     # Show elapsed time for slow test cases
     test_runner = TextTestRunner(resultclass=TimeLoggingTestResult)